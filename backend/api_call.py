@@ -1,74 +1,231 @@
+import asyncio
 import httpx
 import numpy as np
 import cv2
-from typing import Optional
+from concurrent.futures import Executor
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
 
-def _encode_png(img_bgr: np.ndarray) -> bytes:
-    ok, buf = cv2.imencode(".png", img_bgr)
+RAW_BGR_MEDIA_TYPE = "image/x-raw-bgr"
+
+# Transport codecs for the HF round-trip: name -> (extension, media type, imencode params).
+# PNG deflate is slow and serial; WebP/JPEG (libjpeg-turbo) are much cheaper and
+# lossy is fine for a colorized preview. BMP is lossless and nearly free to encode.
+TRANSPORT_CODECS = {
+    "png": (".png", "image/png", []),
+    "webp": (".webp", "image/webp", [cv2.IMWRITE_WEBP_QUALITY, 92]),
+    "jpeg": (".jpg", "image/jpeg", [cv2.IMWRITE_JPEG_QUALITY, 92]),
+    "bmp": (".bmp", "image/bmp", []),
+}
+
+# Shared by the sync and async clients: HTTP/2 lets parallel batch uploads
+# multiplex over one connection instead of queueing on a small HTTP/1.1 pool.
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=60.0)
+HTTP_RETRIES = 1
+# Replies meaning the Space has no batch endpoint; any other 4xx only skips batching for that call.
+BATCH_UNSUPPORTED_STATUSES = {404, 405, 415, 422}
+# Replies asking the client to back off: the batch fails as a whole instead of retrying per-image.
+BATCH_BACKOFF_STATUSES = {429, 503}
+
+def _encode_image(img_bgr: np.ndarray, fmt: str = "png") -> bytes:
+    ext, _, params = TRANSPORT_CODECS[fmt]
+    ok, buf = cv2.imencode(ext, img_bgr, params)
     if not ok:
-        raise ValueError("Failed to encode image as PNG")
+        raise ValueError(f"Failed to encode image as {fmt}")
     return buf.tobytes()
 
-def _decode_png(png_bytes: bytes) -> np.ndarray:
-    arr = np.frombuffer(png_bytes, np.uint8)
+def _decode_image(data: bytes) -> np.ndarray:
+    arr = np.frombuffer(data, np.uint8)
     img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
     if img is None:
-        raise ValueError("Failed to decode PNG from response")
+        raise ValueError("Failed to decode image from response")
     return img
 
+def parse_image_shape(value: Optional[str]) -> Tuple[int, int, int]:
+    """Parse an ``X-Image-Shape`` header of the form ``HxWxC``."""
+    try:
+        h, w, c = (int(v) for v in (value or "").lower().split("x"))
+    except ValueError:
+        raise ValueError(f"Invalid image shape: {value!r}")
+    if h <= 0 or w <= 0 or c != 3:
+        raise ValueError(f"Unsupported image shape: {value!r}")
+    return h, w, c
+
+def encode_raw_bgr(img_bgr: np.ndarray) -> Tuple[memoryview, Dict[str, str]]:
+    """Zero-copy view of the uint8 BGR pixels plus the headers needed to rebuild the array."""
+    img = np.ascontiguousarray(img_bgr, dtype=np.uint8)
+    if img.ndim != 3 or img.shape[2] != 3:
+        raise ValueError("Raw transport expects an HxWx3 BGR image")
+    h, w, c = img.shape
+    headers = {"X-Image-Shape": f"{h}x{w}x{c}", "X-Image-Dtype": "uint8"}
+    return memoryview(img).cast("B"), headers
+
+def decode_raw_bgr(data: bytes, headers: Mapping[str, str]) -> np.ndarray:
+    dtype = headers.get("x-image-dtype", "uint8")
+    if dtype != "uint8":
+        raise ValueError(f"Unsupported image dtype: {dtype}")
+    h, w, c = parse_image_shape(headers.get("x-image-shape"))
+    if len(data) != h * w * c:
+        raise ValueError("Raw image size does not match X-Image-Shape")
+    return np.frombuffer(data, np.uint8).reshape(h, w, c)
+
+def decode_raw_bgr_batch(data: bytes, headers: Mapping[str, str]) -> List[np.ndarray]:
+    """Split concatenated BGR images described by ``X-Image-Shapes: HxWxC,HxWxC,...``."""
+    shapes = [parse_image_shape(v) for v in headers.get("x-image-shapes", "").split(",") if v]
+    if sum(h * w * c for h, w, c in shapes) != len(data):
+        raise ValueError("Raw batch size does not match X-Image-Shapes")
+    flat = np.frombuffer(data, np.uint8)
+    out, offset = [], 0
+    for h, w, c in shapes:
+        out.append(flat[offset:offset + h * w * c].reshape(h, w, c))
+        offset += h * w * c
+    return out
+
 class HFRemoteColorizer:
     """
     Client for your HF Space endpoint:
       - URL must be .../predict.bin
-      - Request: multipart 'image' field
-      - Response: binary image/png
+      - Request: multipart 'image' field, encoded with `image_format`
+        (or, with raw_body=True, the encoded image as the whole request body)
+      - Response: binary image (any format OpenCV can decode)
+
+    process_raw/process_raw_async skip the PNG codecs entirely and send the
+    BGR pixels as application/octet-stream with X-Image-Shape/X-Image-Dtype
+    headers; the endpoint answers in kind (image/x-raw-bgr).
+
+    process_batch_async sends several images in one multipart request (repeated
+    'images' fields) to `batch_url`; the endpoint replies with the colorized
+    pixels concatenated as application/octet-stream plus X-Image-Shapes. Without
+    a batch_url, or if the endpoint answers 4xx, it falls back to per-image calls.
     """
-    def __init__(self, api_url: str, timeout: float = 60.0):
+    def __init__(self, api_url: str, timeout: float = 60.0, image_format: str = "webp", http2: bool = True, raw_body: bool = False,
+                 batch_url: Optional[str] = None, executor: Optional[Executor] = None):
+        if image_format not in TRANSPORT_CODECS:
+            raise ValueError(f"Unsupported transport format: {image_format}")
         self.api_url = api_url.rstrip("/")
         self.timeout = timeout
+        self.image_format = image_format
+        self.http2 = http2
+        self.raw_body = raw_body
+        self.batch_url = batch_url.rstrip("/") if batch_url else None
+        # Where the async methods run image codecs; None means the loop's default executor.
+        self.executor = executor
+        self._ext, self._media_type, _ = TRANSPORT_CODECS[image_format]
+        self._filename = f"input{self._ext}"
+        self._headers = httpx.Headers({"User-Agent": "HFRemoteColorizer/1.2", "Accept": self._media_type})
+        self._body_headers = {"Content-Type": self._media_type}
         self._async_client: Optional[httpx.AsyncClient] = None
         self._sync_client: Optional[httpx.Client] = None
 
 
+    def _post_kwargs(self, data: bytes) -> dict:
+        # A raw body skips multipart boundary/part-header framing and the re-serialization into a new buffer.
+        if self.raw_body:
+            return {"content": data, "headers": self._body_headers}
+        return {"files": {"image": (self._filename, data, self._media_type)}}
+
     def _get_sync(self) -> httpx.Client:
         if self._sync_client is None:
             self._sync_client = httpx.Client(
                 timeout=self.timeout,
-                headers={"User-Agent": "HFRemoteColorizer/1.2", "Accept": "image/png"},
+                headers=self._headers,
+                transport=httpx.HTTPTransport(http2=self.http2, limits=HTTP_LIMITS, retries=HTTP_RETRIES),
             )
         return self._sync_client
 
     def process(self, image_bgr: np.ndarray) -> Optional[np.ndarray]:
         try:
-            png = _encode_png(image_bgr)
-            files = {"image": ("input.png", png, "image/png")}
-            resp = self._get_sync().post(self.api_url, files=files)
+            data = _encode_image(image_bgr, self.image_format)
+            resp = self._get_sync().post(self.api_url, **self._post_kwargs(data))
             resp.raise_for_status()
-            return _decode_png(resp.content) 
+            return _decode_image(resp.content)
         except Exception as e:
             print(f"[HFRemoteColorizer] sync error: {e}")
             return None
 
+    def process_raw(self, image_bgr: np.ndarray) -> Optional[np.ndarray]:
+        try:
+            view, headers = encode_raw_bgr(image_bgr)
+            body = bytes(view)  # httpx treats non-bytes content as an iterable of chunks
+            headers.update({"Content-Type": "application/octet-stream", "Accept": RAW_BGR_MEDIA_TYPE})
+            resp = self._get_sync().post(self.api_url, content=body, headers=headers)
+            resp.raise_for_status()
+            return decode_raw_bgr(resp.content, resp.headers)
+        except Exception as e:
+            print(f"[HFRemoteColorizer] sync raw error: {e}")
+            return None
+
+    async def _off_loop(self, fn: Callable, *args):
+        """Run a CPU-bound codec call off the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
     async def _get_async(self) -> httpx.AsyncClient:
         if self._async_client is None:
             self._async_client = httpx.AsyncClient(
                 timeout=self.timeout,
-                headers={"User-Agent": "HFRemoteColorizer/1.2", "Accept": "image/png"},
+                headers=self._headers,
+                transport=httpx.AsyncHTTPTransport(http2=self.http2, limits=HTTP_LIMITS, retries=HTTP_RETRIES),
             )
         return self._async_client
 
     async def process_async(self, image_bgr: np.ndarray) -> Optional[np.ndarray]:
         try:
-            png = _encode_png(image_bgr)
-            files = {"image": ("input.png", png, "image/png")}
+            data = await self._off_loop(_encode_image, image_bgr, self.image_format)
             client = await self._get_async()
-            resp = await client.post(self.api_url, files=files)
+            resp = await client.post(self.api_url, **self._post_kwargs(data))
             resp.raise_for_status()
-            return _decode_png(resp.content)
+            return await self._off_loop(_decode_image, resp.content)
         except Exception as e:
             print(f"[HFRemoteColorizer] async error: {e}")
             return None
 
+    async def process_raw_async(self, image_bgr: np.ndarray) -> Optional[np.ndarray]:
+        try:
+            view, headers = encode_raw_bgr(image_bgr)
+            body = await self._off_loop(bytes, view)  # httpx treats non-bytes content as an iterable of chunks
+            headers.update({"Content-Type": "application/octet-stream", "Accept": RAW_BGR_MEDIA_TYPE})
+            client = await self._get_async()
+            resp = await client.post(self.api_url, content=body, headers=headers)
+            resp.raise_for_status()
+            return decode_raw_bgr(resp.content, resp.headers)
+        except Exception as e:
+            print(f"[HFRemoteColorizer] async raw error: {e}")
+            return None
+
+    async def process_batch_async(self, images_bgr: List[np.ndarray], raw: bool = False) -> List[Optional[np.ndarray]]:
+        """Colorize a batch in one request when possible; results line up with the inputs."""
+        single = self.process_raw_async if raw else self.process_async
+        if self.batch_url and len(images_bgr) > 1:
+            try:
+                encoded = await asyncio.gather(
+                    *[self._off_loop(_encode_image, img, self.image_format) for img in images_bgr]
+                )
+                files = [
+                    ("images", (f"input_{i}{self._ext}", data, self._media_type))
+                    for i, data in enumerate(encoded)
+                ]
+                client = await self._get_async()
+                resp = await client.post(self.batch_url, files=files, headers={"Accept": "application/octet-stream"})
+                if resp.status_code in BATCH_BACKOFF_STATUSES:
+                    # The Space asked us to back off; fanning out per-image would multiply the load.
+                    print(f"[HFRemoteColorizer] batch throttled ({resp.status_code}, Retry-After={resp.headers.get('retry-after')})")
+                    return [None] * len(images_bgr)
+                if resp.status_code in BATCH_UNSUPPORTED_STATUSES:
+                    # Endpoint does not take batches: stop trying and go per-image from now on.
+                    print(f"[HFRemoteColorizer] batch unsupported ({resp.status_code}); disabling batching")
+                    self.batch_url = None
+                elif 400 <= resp.status_code < 500:
+                    # Batch-specific (408, 413, a bad image): per-image for this batch only.
+                    print(f"[HFRemoteColorizer] batch rejected ({resp.status_code}); falling back to per-image")
+                else:
+                    resp.raise_for_status()
+                    outs = decode_raw_bgr_batch(resp.content, resp.headers)
+                    if len(outs) == len(images_bgr):
+                        return outs
+                    print("[HFRemoteColorizer] batch returned the wrong number of images; retrying per-image")
+            except Exception as e:
+                print(f"[HFRemoteColorizer] batch error: {e}")
+        return list(await asyncio.gather(*[single(img) for img in images_bgr]))
+
     def close(self):
         if self._sync_client is not None:
             self._sync_client.close()
@@ -1,12 +1,16 @@
 import asyncio
 import logging
 import os
-import re
+import queue
 import shutil
 import time
 import uuid
 import hashlib
+import itertools
+from collections import OrderedDict
 from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, List, Optional
 import cv2
@@ -19,7 +23,7 @@ from prometheus_fastapi_instrumentator import Instrumentator
 from prometheus_client import Counter, Histogram
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from .api_call import HFRemoteColorizer
+from .api_call import RAW_BGR_MEDIA_TYPE, HFRemoteColorizer, decode_raw_bgr, encode_raw_bgr
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -29,7 +33,6 @@ logger = logging.getLogger(__name__)
 
 CODE_DIR = Path(__file__).resolve().parent
 APP_DATA = Path("./app_data")
-TEMP_DIR = APP_DATA / "tmp_sessions"
 RESULTS_DIR = APP_DATA / "colorizedImages"
 STATIC_DIR = Path(__file__).resolve().parent.parent / "frontend"
 RL_ALLOWED = Counter(
@@ -52,17 +55,18 @@ MAX_FILES_PER_SESSION = 25
 RATE_LIMIT_WINDOW = 60
 MAX_UPLOADS_PER_MIN = 5
 MAX_UPLOAD_BYTES = 1 * 1024 * 1024   
-CHUNK_SIZE = 64 * 1024
 
-for d in (APP_DATA, TEMP_DIR, RESULTS_DIR, STATIC_DIR):
+for d in (APP_DATA, RESULTS_DIR, STATIC_DIR):
     d.mkdir(parents=True, exist_ok=True)
 
 
 REDIS_URL = os.getenv("REDIS_URL")
+_redis = None
 
 if REDIS_URL:
     try:
         from redis import asyncio as aioredis
+        from redis.exceptions import NoScriptError
         _redis = aioredis.from_url(
             REDIS_URL,
             decode_responses=True,
@@ -80,14 +84,42 @@ else:
 
 
 ALLOWED_MIME_TYPES = {"image/png", "image/jpeg", "image/jpg", "image/webp"}
+MIME_SNIFF_BYTES = 2048
+# One libmagic handle for the process; magic.from_buffer() would reload the database per call.
+_MAGIC = magic.Magic(mime=True)
 upload_history: Dict[str, List[float]] = {}
 api_url=os.getenv("API_URL")
-colorizer = HFRemoteColorizer(api_url=api_url)
+colorizer = HFRemoteColorizer(
+    api_url=api_url,
+    image_format=os.getenv("HF_IMAGE_FORMAT", "webp"),
+    raw_body=os.getenv("HF_RAW_BODY", "0") == "1",
+    batch_url=os.getenv("HF_BATCH_URL"),
+)
+# Set when the HF Space understands raw BGR bodies (see HFRemoteColorizer.process_raw).
+HF_RAW_TRANSPORT = os.getenv("HF_RAW_TRANSPORT", "0") == "1"
+# Optional downscale at decode time for /api/predict: the model works at low
+# resolution anyway, and libjpeg can scale during the DCT instead of after.
+_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+PREDICT_DOWNSCALE = os.getenv("PREDICT_DOWNSCALE", "1")
+if PREDICT_DOWNSCALE not in {str(k) for k in _DECODE_FLAGS}:
+    raise ValueError(f"Unsupported PREDICT_DOWNSCALE: {PREDICT_DOWNSCALE!r} (expected 1, 2, 4 or 8)")
+PREDICT_DECODE_FLAG = _DECODE_FLAGS[int(PREDICT_DOWNSCALE)]
 
 
 MAX_WORKERS = min(32, (os.cpu_count() or 1) * 5)
+# OpenCV codecs are CPU-bound (and release the GIL), so they get one thread per
+# core; blocking network/disk work gets the larger MAX_WORKERS pool.
+CPU_WORKERS = os.cpu_count() or 1
 sem=asyncio.Semaphore(MAX_WORKERS)
-executor: Optional[ThreadPoolExecutor] = None
+# Reusable MAX_UPLOAD_BYTES buffers for /api/predict uploads, one per concurrent request at most.
+_UPLOAD_BUFFERS: "queue.Queue[bytearray]" = queue.Queue(maxsize=MAX_WORKERS)
+cpu_executor: Optional[ThreadPoolExecutor] = None
+io_executor: Optional[ThreadPoolExecutor] = None
 
 
 
@@ -105,29 +137,77 @@ class ProcessingResult(BaseModel):
     processed_count: int
     colorized_images: List[str] = []
 
+# GCRA over two budgets (per-minute and per-day) in one round-trip. Each key holds
+# the theoretical arrival time (TAT, ms). A request of `inc` units pushes the TAT
+# forward by inc * emission interval and is rejected if that lands more than one
+# period ahead of now. `debt` is units already allowed locally (see check_limits);
+# it is always charged, even when `inc` is rejected. Both keys share a hash-tag,
+# so one MGET reads them. Allowed requests get back the headroom left in units.
 RL_LUA = """
-local inc  = tonumber(ARGV[1])
-local mttl = tonumber(ARGV[2])
-local dttl = tonumber(ARGV[3])
-
-local m = redis.call('INCRBY', KEYS[1], inc)
-if m == inc then
-  redis.call('EXPIRE', KEYS[1], mttl)
-end
-
-local d = redis.call('INCRBY', KEYS[2], inc)
-if d == inc then
-  redis.call('EXPIRE', KEYS[2], dttl)
+local now = tonumber(ARGV[1])
+local inc = tonumber(ARGV[2])
+local debt = tonumber(ARGV[3])
+local mint, mper = tonumber(ARGV[4]), tonumber(ARGV[5])
+local dint, dper = tonumber(ARGV[6]), tonumber(ARGV[7])
+local tats = redis.call('MGET', KEYS[1], KEYS[2])
+
+local mbase = math.max(tonumber(tats[1]) or now, now) + mint * debt
+local dbase = math.max(tonumber(tats[2]) or now, now) + dint * debt
+local mtat, dtat = mbase + mint * inc, dbase + dint * inc
+local mwait, dwait = mtat - now - mper, dtat - now - dper
+
+local scope, wait = 0, 0
+if mwait > 0 then scope, wait = 1, mwait
+elseif dwait > 0 then scope, wait = 2, dwait end
+if scope > 0 then
+  if debt == 0 then return {scope, wait, 0} end
+  mtat, dtat = mbase, dbase
 end
 
-return {m, d}
+redis.call('SET', KEYS[1], mtat, 'PX', math.max(1, mtat - now))
+redis.call('SET', KEYS[2], dtat, 'PX', math.max(1, dtat - now))
+if scope > 0 then return {scope, wait, 0} end
+return {0, 0, math.min(math.floor(-mwait / mint), math.floor(-dwait / dint))}
 """
-_RL_LUA_SHA = None
-
-async def _ensure_rl_script_loaded():
+# (emission interval ms, period ms) per budget, precomputed for RL_LUA.
+RL_MINUTE_ARGS = (-(-RATE_LIMIT_WINDOW * 1000 // MAX_UPLOADS_PER_MIN), RATE_LIMIT_WINDOW * 1000)
+RL_DAY_ARGS = (-(-86400 * 1000 // MAX_FILES_PER_SESSION), 86400 * 1000)
+_RL_LUA_SHA: Optional[str] = None
+# In-process allowance cache: after Redis reports `headroom` units left for a key,
+# up to headroom - RL_LOCAL_MARGIN more units are allowed locally for RL_LOCAL_TTL
+# seconds and charged to Redis as `debt` on the key's next round-trip. The margin
+# absorbs concurrent use of the same key on other replicas. RL_LOCAL_TTL=0 disables.
+# Debt is never dropped: it is put back if Redis fails and flushed in the
+# background when its entry is evicted. There is no timed flush, so a key that
+# goes quiet keeps its debt in memory until its next request or eviction.
+# Each round-trip gets a sequence number; credits are only installed from the
+# newest one issued for the key, so a slow, stale reply can't hand out headroom
+# that later requests already used.
+RL_LOCAL_TTL = float(os.getenv("RL_LOCAL_TTL", "1.0"))
+RL_LOCAL_MARGIN = 2
+RL_LOCAL_MAX_KEYS = 8192
+
+@dataclass
+class _LocalAllowance:
+    expires: float
+    credits: int
+    debt: int = 0
+    seq: int = 0
+
+_rl_local: "OrderedDict[str, _LocalAllowance]" = OrderedDict()
+_rl_seq = itertools.count(1)
+# Newest sequence number issued per key, while a round-trip for it is in flight.
+_rl_latest_seq: Dict[str, int] = {}
+_rl_flush_tasks: "set[asyncio.Task]" = set()
+_rl_script_lock = asyncio.Lock()
+
+async def _reload_rl_script(r, stale_sha: Optional[str]) -> str:
+    """SCRIPT LOAD once for all callers that saw the same stale SHA."""
     global _RL_LUA_SHA
-    if _redis and not _RL_LUA_SHA:
-        _RL_LUA_SHA = await _redis.script_load(RL_LUA)
+    async with _rl_script_lock:
+        if _RL_LUA_SHA == stale_sha:
+            _RL_LUA_SHA = await r.script_load(RL_LUA)
+        return _RL_LUA_SHA
 
 def real_client_ip(request: Request) -> str:
     xff = request.headers.get("x-forwarded-for")
@@ -136,156 +216,255 @@ def real_client_ip(request: Request) -> str:
         ip = ip.split(":")[-1]
     return ip
 
+@lru_cache(maxsize=8192)
+def _fingerprint_hash(fp: str) -> str:
+    return hashlib.sha1(fp.encode()).hexdigest()[:8]
+
 def make_rate_key(request: Request, fingerprint: Optional[str] = None) -> str:
     ip = real_client_ip(request)
     fp = fingerprint or request.headers.get("x-client-fingerprint") or ""
     if fp:
-        fp_hash = hashlib.sha1(fp.encode()).hexdigest()[:8]
-        return f"{ip}:{fp_hash}"
+        return f"{ip}:{_fingerprint_hash(fp)}"
     return ip
 
-async def check_limits(r, key: str, inc: int = 1):
-    if not r:
-        raise HTTPException(503, "Rate limiter unavailable")
-
-    now = time.time()
-    minute_bucket = int(now // RATE_LIMIT_WINDOW)  
-    day_bucket    = int(now // 86400)            
+async def _eval_limits(r, key: str, inc: int, debt: int):
+    now_ms = int(time.time() * 1000)
 
-    mkey = f"rl:{key}:m:{minute_bucket}"
-    dkey = f"rl:{key}:d:{day_bucket}"
-
-    mttl = RATE_LIMIT_WINDOW * 2    
-    dttl = 86400 + 600               
-
-   
-    await _ensure_rl_script_loaded()
+    # {key} is a Redis Cluster hash-tag: both keys land on the same slot for EVAL.
+    mkey = f"rl:{{{key}}}:m"
+    dkey = f"rl:{{{key}}}:d"
+    args = (now_ms, inc, debt, *RL_MINUTE_ARGS, *RL_DAY_ARGS)
 
+    sha = _RL_LUA_SHA or await _reload_rl_script(r, None)
     try:
-        res = await r.evalsha(_RL_LUA_SHA, 2, mkey, dkey, inc, mttl, dttl)
-    except Exception:       
-        res = await r.eval(RL_LUA, 2, mkey, dkey, inc, mttl, dttl)
-        try:
-            
-            globals()["_RL_LUA_SHA"] = await r.script_load(RL_LUA)
-        except Exception:
-            pass
+        return await r.evalsha(sha, 2, mkey, dkey, *args)
+    except NoScriptError:
+        # Script cache flushed (restart/failover): reload once, then retry.
+        sha = await _reload_rl_script(r, sha)
+        return await r.evalsha(sha, 2, mkey, dkey, *args)
 
-    mcount = int(res[0])
-    dcount = int(res[1])
+async def _flush_debt(r, key: str, debt: int):
+    try:
+        await _eval_limits(r, key, 0, debt)
+    except Exception as e:
+        logger.warning(f"Rate limit debt flush failed for {key}: {e}")
+        _carry_debt(r, key, debt)
+
+def _carry_debt(r, key: str, debt: int):
+    """Keep locally allowed units on the key's entry so a later round-trip charges them."""
+    if debt <= 0:
+        return
+    entry = _rl_local.get(key)
+    if entry is not None:
+        entry.debt += debt
+        return
+    _rl_local[key] = _LocalAllowance(0.0, 0, debt)
+    _evict_local(r)
+
+def _evict_local(r):
+    while len(_rl_local) > RL_LOCAL_MAX_KEYS:
+        key, entry = _rl_local.popitem(last=False)
+        if entry.debt:
+            task = asyncio.create_task(_flush_debt(r, key, entry.debt))
+            _rl_flush_tasks.add(task)
+            task.add_done_callback(_rl_flush_tasks.discard)
 
-    if mcount > MAX_UPLOADS_PER_MIN:
-        retry = str(RATE_LIMIT_WINDOW - int(now % RATE_LIMIT_WINDOW))
+async def check_limits(r, key: str, inc: int = 1):
+    if not r:
+        raise HTTPException(503, "Rate limiter unavailable")
+    if inc < 1:
+        raise HTTPException(400, "File count must be at least 1")
+
+    # The cache is only touched between awaits on the event loop, so no lock is
+    # needed; an entry is popped before the Redis call so its debt is sent once.
+    now = time.monotonic()
+    entry = _rl_local.pop(key, None)
+    if entry is not None and entry.expires > now and entry.credits >= inc:
+        entry.credits -= inc
+        entry.debt += inc
+        _rl_local[key] = entry
+        return
+    debt = entry.debt if entry is not None else 0
+
+    seq = next(_rl_seq)
+    _rl_latest_seq[key] = seq
+    try:
+        scope, wait_ms, headroom = await _eval_limits(r, key, inc, debt)
+    except Exception:
+        _carry_debt(r, key, debt)
+        raise
+    finally:
+        newest = _rl_latest_seq.get(key) == seq
+        if newest:
+            del _rl_latest_seq[key]
+
+    # A concurrent request on this key may have stored (and spent from) an entry
+    # during the await; its debt has not reached Redis yet, so it is carried over
+    # and counted against the new credits.
+    pending = _rl_local.pop(key, None)
+    pending_debt = pending.debt if pending is not None else 0
+    credits = headroom - RL_LOCAL_MARGIN - pending_debt
+    if (scope == 0 and RL_LOCAL_TTL > 0 and credits > 0 and newest
+            and (pending is None or pending.seq < seq)):
+        _rl_local[key] = _LocalAllowance(now + RL_LOCAL_TTL, credits, pending_debt, seq)
+        _evict_local(r)
+    elif pending is not None:
+        _rl_local[key] = pending
+
+    retry = str(max(1, -(-wait_ms // 1000)))
+
+    if scope == 1:
         raise HTTPException(
-            429, "Rate limit exceeded. Try again in a minute.",
+            429, f"Rate limit exceeded. Try again in {retry}s.",
             headers={"Retry-After": retry}
         )
-    if dcount > MAX_FILES_PER_SESSION:
-        retry = str(86400 - int(now % 86400))
+    if scope == 2:
         raise HTTPException(
-            429, "Daily quota reached. Try again tomorrow.",
+            429, f"Daily quota reached. Try again in {retry}s.",
             headers={"Retry-After": retry}
         )
 
-def verify_image_type(upload_file: UploadFile):
-    sample = upload_file.file.read(2048)
-    mime = magic.from_buffer(sample, mime=True)
-    upload_file.file.seek(0)
+def _check_mime(sample: bytes):
+    mime = _MAGIC.from_buffer(sample)
     if mime not in ALLOWED_MIME_TYPES:
         raise HTTPException(status_code=400, detail=f"Unsupported file type: {mime}")
-    
-def create_temp_dir(session_token: str) -> Path:
-    temp_dir = TEMP_DIR / session_token
-    temp_dir.mkdir(parents=True, exist_ok=True)
-    return temp_dir
+
+def _next_result_index(results_dir: Path) -> int:
+    """One past the highest N among colorized_N.png in results_dir."""
+    last = -1
+    with os.scandir(results_dir) as it:
+        for entry in it:
+            n = entry.name
+            if n.startswith("colorized_") and n.endswith(".png"):
+                digits = n[10:-4]
+                if digits.isascii() and digits.isdigit():
+                    last = max(last, int(digits))
+    return last + 1
 
 def create_results_dir(session_token: str) -> Path:
     results_dir = RESULTS_DIR / session_token
     results_dir.mkdir(parents=True, exist_ok=True)
     return results_dir
-def real_client_ip(request: Request) -> str:
-    xff = request.headers.get("x-forwarded-for")
-    if xff:
-        return xff.split(",")[0].strip()
-    return request.client.host or "unknown"
 
-async def save_upload_file_async_chunked(upload: UploadFile, dest: Path, limit: int = MAX_UPLOAD_BYTES, chunk_size: int = 256 * 1024):
-    loop = asyncio.get_running_loop()
-    dest.parent.mkdir(parents=True, exist_ok=True)
-    dest.write_bytes(b"")
-    total = 0
-    def _append(dst: Path, data: bytes):
-        with dst.open("ab") as f: f.write(data)
-    while True:
-        data = await upload.read(chunk_size)
-        if not data: break
-        total += len(data)
-        if total > limit:
-            while await upload.read(chunk_size): pass
-            raise HTTPException(413, f"File too large (>{limit} bytes)")
-        await loop.run_in_executor(executor, _append, dest, data)
-    await upload.seek(0)
-
-def process_image_sync(input_path: Path, output_path: Path) -> bool:
+async def _decode_upload(upload: UploadFile, flags: int = cv2.IMREAD_COLOR) -> Optional[np.ndarray]:
+    """Read, MIME-check and decode an upload entirely in memory; None if it does not decode."""
+    buf = _acquire_upload_buffer()
     try:
-        start=time.perf_counter()
-        img = cv2.imread(str(input_path))
+        n = _read_limited(upload, MAX_UPLOAD_BYTES, buf)
+        _check_mime(bytes(memoryview(buf)[:min(n, MIME_SNIFF_BYTES)]))
+
+        # cv2.imdecode has no dst= in Python and nothing here resizes before the
+        # HF call, so there is no fixed-size array to reuse. A thread-local one
+        # would also be unsafe: the decoded image outlives this cpu_executor call
+        # while it is colorized. Use PREDICT_DOWNSCALE to shrink the allocation.
+        loop = asyncio.get_running_loop()
+        # imdecode owns its output, so the upload buffer can go back right away.
+        return await loop.run_in_executor(cpu_executor, cv2.imdecode, np.frombuffer(buf, np.uint8, count=n), flags)
+    finally:
+        _release_upload_buffer(buf)
+
+async def _colorize_batch(imgs: List[Optional[np.ndarray]], output_paths: List[Path]) -> List[bool]:
+    """Colorize a batch in one HF round-trip where supported, and save the results."""
+    loop = asyncio.get_running_loop()
+    ok = [False] * len(imgs)
+    todo = []
+    for i, img in enumerate(imgs):
         if img is None:
-            logger.error(f"Failed to load image: {input_path}")
-            return False
-        out = colorizer.process(img)
-        COLORIZE_SECONDS.observe(time.perf_counter() - start)
+            logger.error(f"Failed to decode image for: {output_paths[i].name}")
+        else:
+            todo.append(i)
+    if not todo:
+        return ok
+
+    async with sem:
+        start=time.perf_counter()
+        outs = await colorizer.process_batch_async([imgs[i] for i in todo], raw=HF_RAW_TRANSPORT)
+        per_image = (time.perf_counter() - start) / len(todo)
+    for _ in todo:
+        COLORIZE_SECONDS.observe(per_image)
+
+    writes = {}
+    for i, out in zip(todo, outs):
         if out is None:
-            logger.error(f"Colorizer returned None for: {input_path.name}")
-            return False
-        ok = cv2.imwrite(str(output_path), out)
-        return bool(ok)
-    except Exception:
-        logger.exception("process_image_sync error")
-        return False
-async def _read_limited(upload: UploadFile, limit: int) -> bytes:
-    """Stream the upload without reading everything at once; enforce size limit."""
-    total = 0
-    buf = bytearray()
-    while True:
-        chunk = await upload.read(CHUNK_SIZE)
-        if not chunk:
-            break
-        total += len(chunk)
-        if total > limit:
-            
-            while await upload.read(CHUNK_SIZE):
-                pass
-            raise HTTPException(status_code=413, detail=f"File too large (>{limit} bytes)")
-        buf.extend(chunk)
-    return bytes(buf)
+            logger.error(f"Colorizer returned None for: {output_paths[i].name}")
+            continue
+        writes[i] = loop.run_in_executor(cpu_executor, cv2.imwrite, str(output_paths[i]), out)
+    results = await asyncio.gather(*writes.values(), return_exceptions=True)
+    for i, res in zip(writes, results):
+        if isinstance(res, BaseException):
+            logger.error(f"Failed to write {output_paths[i].name}: {res}")
+        else:
+            ok[i] = bool(res)
+    return ok
+
+def _acquire_upload_buffer() -> bytearray:
+    try:
+        return _UPLOAD_BUFFERS.get_nowait()
+    except queue.Empty:
+        return bytearray(MAX_UPLOAD_BYTES)
+
+def _release_upload_buffer(buf: bytearray) -> None:
+    try:
+        _UPLOAD_BUFFERS.put_nowait(buf)
+    except queue.Full:
+        pass
+
+def _read_limited(upload: UploadFile, limit: int, buf: bytearray) -> int:
+    """Copy the upload into a preallocated buffer in one read; enforce size limit. Returns bytes read.
+
+    Starlette spools uploads below its 1 MB threshold in memory, so this
+    readinto() is a memcpy rather than a chain of awaited chunk reads.
+    """
+    if limit > len(buf):
+        raise ValueError("Upload buffer is smaller than the size limit")
+    if upload.size is not None and upload.size > limit:
+        raise HTTPException(status_code=413, detail=f"File too large (>{limit} bytes)")
+    upload.file.seek(0)
+    n = upload.file.readinto(memoryview(buf)[:limit])
+    if n == limit and upload.file.read(1):
+        raise HTTPException(status_code=413, detail=f"File too large (>{limit} bytes)")
+    return n
 
 async def _colorize_np_bgr(img_bgr: np.ndarray) -> np.ndarray:
     """Offload the blocking HF call to the threadpool."""
     loop = asyncio.get_running_loop()
     def _run():
-        out = colorizer.process(img_bgr)  
+        out = colorizer.process_raw(img_bgr) if HF_RAW_TRANSPORT else colorizer.process(img_bgr)
         if out is None:
             raise RuntimeError("Colorizer returned None")
         return out
-    return await loop.run_in_executor(executor, _run)
+    return await loop.run_in_executor(io_executor, _run)
 
-async def _encode_png(img_bgr: np.ndarray) -> bytes:
+async def _encode_image(img_bgr: np.ndarray, ext: str = ".png", params: tuple = ()) -> memoryview:
+    """Encode and hand back a view over OpenCV's buffer (no tobytes() copy)."""
     loop = asyncio.get_running_loop()
     def _run():
-        ok, buf = cv2.imencode(".png", img_bgr)
+        ok, buf = cv2.imencode(ext, img_bgr, list(params))
         if not ok:
-            raise RuntimeError("PNG encode failed")
-        return buf.tobytes()
-    return await loop.run_in_executor(executor, _run)
+            raise RuntimeError(f"{ext} encode failed")
+        return buf.reshape(-1).data
+    return await loop.run_in_executor(cpu_executor, _run)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global executor
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    global cpu_executor, io_executor
+    cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cv")
+    io_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="io")
+    colorizer.executor = cpu_executor
+    # OpenCV calls already run in parallel across cpu_executor threads (one per
+    # core); keep its internal pool from oversubscribing the cores on top.
+    cv2.setNumThreads(1)
+    jpeg_info = [l.strip() for l in cv2.getBuildInformation().splitlines() if l.strip().startswith("JPEG:")]
+    logger.info(f"OpenCV codec build: {jpeg_info[0] if jpeg_info else 'JPEG: unknown'}")
+    if _redis:
+        try:
+            await _reload_rl_script(_redis, None)
+        except Exception as e:
+            logger.warning(f"Rate limit script preload failed; will retry on first request: {e}")
     yield
-    executor.shutdown(wait=False)
+    cpu_executor.shutdown(wait=False)
+    io_executor.shutdown(wait=False)
     try:
         await colorizer.aclose()
     except Exception:
@@ -343,48 +522,23 @@ async def colorize_images(
         raise
 
     sessionToken = sessionToken or str(uuid.uuid4())
-    temp_dir = create_temp_dir(sessionToken)
     results_dir = create_results_dir(sessionToken)
 
     try:
-        existing = list(results_dir.glob("colorized_*.png"))
-        indices = []
-        for p in existing:
-            m = re.match(r"colorized_(\d+)\.png$", p.name)
-            if m:
-                indices.append(int(m.group(1)))
-        next_start = max(indices, default=-1) + 1
-
-        input_paths, output_paths = [], []
-        for i, upload in enumerate(files):
-            verify_image_type(upload)
-            ext =  ".png"
-            in_path = temp_dir / f"input_{i}{ext}"
-            out_index = next_start + i
-            out_path = results_dir / f"colorized_{out_index}.png"
-
-            await save_upload_file_async_chunked(upload, in_path, limit=MAX_UPLOAD_BYTES)
-
-            input_paths.append(in_path)
-            output_paths.append(out_path)
+        next_start = _next_result_index(results_dir)
 
-    
-        futures = [
-            executor.submit(process_image_sync, in_p, out_p)
-            for in_p, out_p in zip(input_paths, output_paths)
-        ]
+        output_paths = [results_dir / f"colorized_{next_start + i}.png" for i in range(len(files))]
+        imgs = await asyncio.gather(*[_decode_upload(upload) for upload in files])
+
+        outcomes = await _colorize_batch(imgs, output_paths)
 
         processed = 0
         result_urls = []
-        for fut, out_p in zip(futures, output_paths):
-            try:
-                success = await asyncio.wrap_future(fut)
-                logging.info(f"Processed {out_p.name}: {success}, exists={out_p.exists()}")
-                if success and out_p.exists():
-                    processed += 1
-                    result_urls.append(f"/api/result/{sessionToken}/{out_p.name}")
-            except Exception as e:
-                logging.error(f"Error during processing {out_p.name}: {e}")
+        for success, out_p in zip(outcomes, output_paths):
+            logging.info(f"Processed {out_p.name}: {success}, exists={out_p.exists()}")
+            if success and out_p.exists():
+                processed += 1
+                result_urls.append(f"/api/result/{sessionToken}/{out_p.name}")
 
         if processed == 0:
             raise HTTPException(500, "Failed to process any images")
@@ -402,10 +556,6 @@ async def colorize_images(
     except Exception as e:
         logging.error(f"Unexpected error in colorize_images: {e}", exc_info=True)
         raise HTTPException(500, f"Processing failed: {e}")
-    finally:
-       
-        if temp_dir.exists():
-            shutil.rmtree(temp_dir, ignore_errors=True)
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
 @app.get("/api/result/{session_token}/{filename}")
@@ -457,11 +607,6 @@ async def cleanup_old_files(max_age_hours: int = 2):
         if d.is_dir() and d.stat().st_mtime < cutoff:
             shutil.rmtree(d, ignore_errors=True)
             cleaned += 1
-  
-    for d in TEMP_DIR.iterdir():
-        if d.is_dir() and d.stat().st_mtime < cutoff:
-            shutil.rmtree(d, ignore_errors=True)
-            cleaned += 1
     return {"message": f"Cleaned up {cleaned} old sessions"}
 
 @app.post("/api/predict")
@@ -478,29 +623,47 @@ async def predict_bin(request: Request, image: UploadFile = File(...)):
             RL_BLOCKED.labels(scope="predict_bin").inc()
         raise
 
-    verify_image_type(image)
-    raw = await _read_limited(image, MAX_UPLOAD_BYTES)
-
-    arr = np.frombuffer(raw, np.uint8)
-    img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise HTTPException(400, "Could not decode image")
-    start = time.perf_counter()
-    async with sem:  
-        out = await _colorize_np_bgr(img)
-    COLORIZE_SECONDS.observe(time.perf_counter() - start)
-    png_bytes = await _encode_png(out)
+    buf = None
+    try:
+        # Raw pixels are opt-in via X-Image-Shape; application/octet-stream alone is
+        # just what clients send when they can't guess a file's type.
+        if "x-image-shape" in request.headers:
+            buf = _acquire_upload_buffer()
+            n = _read_limited(image, MAX_UPLOAD_BYTES, buf)
+            try:
+                img = decode_raw_bgr(memoryview(buf)[:n], request.headers)
+            except ValueError as e:
+                raise HTTPException(400, str(e))
+        else:
+            img = await _decode_upload(image, PREDICT_DECODE_FLAG)
+            if img is None:
+                raise HTTPException(400, "Could not decode image")
+        start = time.perf_counter()
+        async with sem:
+            out = await _colorize_np_bgr(img)
+        COLORIZE_SECONDS.observe(time.perf_counter() - start)
+    finally:
+        # Raw uploads are decoded as a view over buf, so it is held until colorizing is done.
+        if buf is not None:
+            _release_upload_buffer(buf)
+
+    # Content negotiation: raw pixels and WebP skip the (slow, deflate-bound) PNG encode.
+    headers = {"Cache-Control": "no-store", "Vary": "Accept"}
+    accept = request.headers.get("accept", "")
+    if RAW_BGR_MEDIA_TYPE in accept or "application/octet-stream" in accept:
+        body, raw_headers = encode_raw_bgr(out)
+        headers.update(raw_headers)
+        media_type = RAW_BGR_MEDIA_TYPE if RAW_BGR_MEDIA_TYPE in accept else "application/octet-stream"
+    elif "image/webp" in accept:
+        body = await _encode_image(out, ".webp", (cv2.IMWRITE_WEBP_QUALITY, 90))
+        media_type = "image/webp"
+    else:
+        body = await _encode_image(out)
+        media_type = "image/png"
 
-    
     dt_ms = int((time.time() - t0) * 1000)
-    return Response(
-        content=png_bytes,
-        media_type="image/png",
-        headers={
-            "Cache-Control": "no-store",
-            "X-Process-Time-ms": str(dt_ms),
-        },
-    )
+    headers["X-Process-Time-ms"] = str(dt_ms)
+    return Response(content=body, media_type=media_type, headers=headers)
 
 
 